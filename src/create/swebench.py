@@ -1,273 +1,684 @@
 import os
 import re
+import fcntl
 import chardet
 import unidiff
 import shutil
+import uuid
+import atexit
+import threading
+import hashlib
 import argparse
 import datasets
+import diskcache
 import traceback
 import subprocess
-from git import Repo
+import multiprocessing
+from functools import partial
+from itertools import repeat
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from utils import save_tsv_dict, save_file_jsonl
-from get_repo_structure.get_repo_structure import get_project_structure_from_scratch
+from get_repo_structure.get_repo_structure import create_structure, repo_to_top_folder
 from get_repo_structure.get_patch_info import *
 
+try:
+    import charset_normalizer
+except ImportError:
+    charset_normalizer = None
+
+# bare clones are shared across runs and workers, and only fetch what the cache is missing
+REPO_CACHE_DIR = os.path.expanduser("~/.cache/cornstack/repos")
+
+# readmes and lazy file listings of the last (repo, base_commit) pair ingested by this process.
+# Instances are sorted by commit, so a worker that gets several of the same commit in a chunk reuses it,
+# anything older is only served from the on-disk cache
+_REPO_COMMIT_CACHE: dict[tuple[str, str], dict] = {}
+
+# smallest number of blobs worth handing to a separate cat-file process
+INGEST_SHARD_SIZE = 32
+
+# encoding detection only looks at the head of a file, its accuracy saturates quickly
+ENCODING_SNIFF_SIZE = 64 * 1024
+
 # %% Get oracle file contents
 
 # get oracle file contents from the repo
 class ContextManager:
+    """Reads the tree of base_commit straight from a bare clone, without a working tree"""
+
     def __init__(self, repo_path, base_commit, verbose=False):
         self.repo_path = Path(repo_path).resolve().as_posix()
-        self.old_dir = os.getcwd()
         self.base_commit = base_commit
         self.verbose = verbose
+        self.tree = None
 
     def __enter__(self):
-        os.chdir(self.repo_path)
-        cmd = f"git reset --hard {self.base_commit} && git clean -fdxq"
-        if self.verbose:
-            subprocess.run(cmd, shell=True, check=True)
-        else:
-            subprocess.run(
-                cmd,
-                shell=True,
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
+        self.tree = list_tree(self.repo_path, self.base_commit)
         return self
 
     def get_environment(self):
         raise NotImplementedError()  # TODO: activate conda environment and return the environment file
 
     def get_readme_files(self):
-        files = os.listdir(self.repo_path)
-        files = list(filter(lambda x: os.path.isfile(x), files))
-        files = list(filter(lambda x: x.lower().startswith("readme"), files))
-        return files
+        return [
+            path for path in self.tree
+            if "/" not in path and path.lower().startswith("readme")
+        ]
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        os.chdir(self.old_dir)
+        pass
 
 
 class AutoContextManager(ContextManager):
-    """Automatically clones the repo if it doesn't exist"""
+    """Automatically clones the repo into the cache if it doesn't exist"""
 
     def __init__(self, instance, root_dir=None, verbose=False, token=None):
         if token is None:
             token = os.environ.get("GITHUB_TOKEN", "git")
-        self.tempdir = None
-        if root_dir is None:
-            self.tempdir = TemporaryDirectory()
-            root_dir = self.tempdir.name
-        self.root_dir = root_dir
-        repo_dir = os.path.join(self.root_dir, instance["repo"].replace("/", "__"))
-        if not os.path.exists(repo_dir):
-            repo_url = (
-                f"https://{token}@github.com/swe-bench/"
-                + instance["repo"].replace("/", "__")
-                + ".git"
-            )
-            if verbose:
-                print(f"Cloning {instance['repo']} to {root_dir}")
-            Repo.clone_from(repo_url, repo_dir)
-        super().__init__(repo_dir, instance["base_commit"], verbose=verbose)
+        self.root_dir = REPO_CACHE_DIR if root_dir is None else root_dir
+        os.makedirs(self.root_dir, exist_ok=True)
+        repo_name = instance["repo"].replace("/", "__")
+        repo_dir = os.path.join(self.root_dir, repo_name + ".git")
+        repo_url = f"https://{token}@github.com/swe-bench/{repo_name}.git"
+        base_commit = instance["base_commit"]
+        commit_ref = f"refs/commits/{base_commit}"
+        output = None if verbose else subprocess.DEVNULL
+        # workers share the cache, so only one of them may clone or fetch a repo at a time
+        with open(repo_dir + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(repo_dir):
+                if verbose:
+                    print(f"Cloning {instance['repo']} to {self.root_dir}")
+                # clone next to the cache entry first so an interrupted clone never looks complete
+                shutil.rmtree(repo_dir + ".tmp", ignore_errors=True)
+                subprocess.run(
+                    ["git", "clone", "--bare", "--filter=blob:none", "--no-checkout", "--depth=1", repo_url, repo_dir + ".tmp"],
+                    check=True,
+                    stdout=output,
+                    stderr=output,
+                )
+                # keep the token out of the cached config, missing blobs are lazily fetched from the public url
+                subprocess.run(
+                    ["git", "--git-dir", repo_dir + ".tmp", "remote", "set-url", "origin", f"https://github.com/swe-bench/{repo_name}.git"],
+                    check=True,
+                )
+                os.rename(repo_dir + ".tmp", repo_dir)
+            if not has_commit(repo_dir, base_commit):
+                if verbose:
+                    print(f"Fetching {base_commit} into {repo_dir}")
+                subprocess.run(
+                    ["git", "--git-dir", repo_dir, "fetch", "--depth=1", repo_url, f"{base_commit}:{commit_ref}"],
+                    check=True,
+                    stdout=output,
+                    stderr=output,
+                )
+        super().__init__(repo_dir, base_commit, verbose=verbose)
         self.instance = instance
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.tempdir is not None:
-            self.tempdir.cleanup()
-        return super().__exit__(exc_type, exc_val, exc_tb)
 
+def has_commit(repo_path, commit):
+    """
+    Checks whether commit was fetched into the bare clone
+    """
+    if not os.path.exists(repo_path):
+        return False
+    # look the commit up through its ref, probing the object itself would lazily fetch its whole history
+    return bool(subprocess.run(
+        ["git", "--git-dir", repo_path, "for-each-ref", f"refs/commits/{commit}"],
+        check=True,
+        capture_output=True,
+    ).stdout)
 
-def ingest_files(filenames):
-    files_dict = dict()
-    for filename in filenames:
-        with open(filename) as f:
-            content = f.read()
-        files_dict[filename] = content
-    return files_dict
+def list_tree(repo_path, commit):
+    """
+    Returns a {path: blob sha} mapping of every file in the tree of commit
+    """
+    output = subprocess.run(
+        ["git", "--git-dir", repo_path, "ls-tree", "-r", "-z", commit],
+        check=True,
+        capture_output=True,
+    ).stdout.decode("utf-8", errors="surrogateescape")
+    tree = {}
+    for entry in output.split("\0"):
+        if not entry:
+            continue
+        info, path = entry.split("\t", 1)
+        _, object_type, sha = info.split()
+        if object_type == "blob":
+            tree[path] = sha
+    return tree
 
-def get_oracle_filenames(instance):
+def fetch_missing_blobs(repo_path, commit, shas):
     """
-    Returns the filenames that are changed in the patch
+    Downloads the given blobs of a partial clone in one batch, instead of one lazy fetch per blob
     """
-    source_files = {
-        patch_file.source_file.split("a/", 1)[-1]
-        for patch_file in unidiff.PatchSet(instance["patch"])
-    }
-    gold_docs = set()
-    for source_file in source_files:
-        gold_docs.add(source_file)
-    return gold_docs
+    missing = subprocess.run(
+        ["git", "--git-dir", repo_path, "rev-list", "--objects", "--no-walk", "--missing=print", commit],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    missing = {line[1:] for line in missing if line.startswith("?")}
+    missing = [sha for sha in shas if sha in missing]
+    if not missing:
+        return
+    subprocess.run(
+        [
+            "git", "--git-dir", repo_path, "-c", "fetch.negotiationAlgorithm=noop",
+            "fetch", "origin", "--no-tags", "--no-write-fetch-head",
+            "--recurse-submodules=no", "--filter=blob:none", "--stdin",
+        ],
+        input="\n".join(missing) + "\n",
+        check=True,
+        capture_output=True,
+        text=True,
+    )
 
+class GitWorker:
+    """Long-lived `git cat-file --batch` process answering blob reads for one repo"""
 
-# get all file contents from the repo
-def is_test(name, test_phrases=None):
-    if test_phrases is None:
-        test_phrases = ["test", "tests", "testing"]
-    words = set(re.split(r" |_|\/|\.", name.lower()))
-    return any(word in words for word in test_phrases)
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.lock = threading.Lock()
+        self.proc = subprocess.Popen(
+            ["git", "--git-dir", repo_path, "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def read_blob(self, sha):
+        with self.lock:
+            self.proc.stdin.write(f"{sha}\n".encode())
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                raise ValueError(f"Object {sha} is missing from {self.repo_path}")
+            rawdata = self.proc.stdout.read(int(header[2]))
+            self.proc.stdout.read(1)  # trailing newline after the object contents
+        return rawdata
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+# cat-file workers of this process by (repo_path, slot), every ingest thread reads through its own slot.
+# Kept in least recently used order, workers of all but the last MAX_GIT_WORKER_REPOS repos are closed
+_GIT_WORKERS: dict[tuple[str, int], GitWorker] = {}
+MAX_GIT_WORKER_REPOS = 4
+
+def get_git_worker(repo_path, slot=0):
+    worker = _GIT_WORKERS.pop((repo_path, slot), None)
+    if worker is None or not worker.is_alive():
+        worker = GitWorker(repo_path)
+    _GIT_WORKERS[(repo_path, slot)] = worker
+    # repos ordered by their most recently used slot, newest first
+    repo_paths = list(dict.fromkeys(repo for repo, _ in reversed(list(_GIT_WORKERS))))
+    if len(repo_paths) > MAX_GIT_WORKER_REPOS:
+        close_git_workers(repo_paths[MAX_GIT_WORKER_REPOS:])
+    return worker
+
+def close_git_workers(repo_paths=None):
+    """
+    Closes the workers of the given repos, or all of them
+    """
+    for key in list(_GIT_WORKERS):
+        if repo_paths is None or key[0] in repo_paths:
+            worker = _GIT_WORKERS.pop(key, None)
+            if worker is not None:
+                worker.close()
+
+def _drop_inherited_git_workers():
+    # the processes belong to the parent, a forked child only closes its copies of the pipes.
+    # Closing the raw files first keeps the child from flushing anything the parent had buffered
+    for worker in _GIT_WORKERS.values():
+        for pipe in (worker.proc.stdin, worker.proc.stdout):
+            pipe.raw.close()
+            pipe.close()
+    _GIT_WORKERS.clear()
+
+atexit.register(close_git_workers)
+# forked pool workers must not share the parent's pipes, they start their own workers on demand
+os.register_at_fork(after_in_child=_drop_inherited_git_workers)
+
+def read_blobs(repo_path, shas, slot=0):
+    """
+    Streams the raw contents of the given blobs through this process's cat-file worker for the repo
+    """
+    worker = get_git_worker(repo_path, slot)
+    for sha in shas:
+        yield worker.read_blob(sha)
+
+def get_num_io_threads():
+    return max(int(os.environ.get("INGEST_IO_THREADS", 8)), 1)
 
-def list_files(root_dir, include_tests=False):
+def _ingest_blobs(repo_path, filenames, shas, slot=0):
     files = []
-    for filename in Path(root_dir).rglob("*.py"):
-        if not include_tests and is_test(filename.as_posix()):
-            continue
-        files.append(filename.relative_to(root_dir).as_posix())
+    for rawdata, filename in zip(read_blobs(repo_path, shas, slot=slot), filenames):
+        content = decode_contents(rawdata)
+        if content is None:
+            content = "[BINARY DATA FILE]"
+        files.append((filename, content))
     return files
 
-def detect_encoding(filename):
+def iter_files(cm, filenames, fetch=True):
     """
-    Detect the encoding of a file
+    Yields (filename, content) pairs, streaming each blob once from the bare clone
     """
-    with open(filename, "rb") as file:
-        rawdata = file.read()
-    return chardet.detect(rawdata)["encoding"]
-
-def ingest_directory_contents(root_dir, include_tests=False):
-    files_content = {}
-    for relative_path in list_files(root_dir, include_tests=include_tests):
-        filename = os.path.join(root_dir, relative_path)
-        encoding = detect_encoding(filename)
-        if encoding is None:
-            content = "[BINARY DATA FILE]"
-        else:
+    filenames = list(filenames)
+    shas = [cm.tree[filename] for filename in filenames]
+    if fetch:
+        fetch_missing_blobs(cm.repo_path, cm.base_commit, shas)
+    n_shards = min(get_num_io_threads(), -(-len(filenames) // INGEST_SHARD_SIZE))
+    if n_shards <= 1:
+        yield from _ingest_blobs(cm.repo_path, filenames, shas)
+        return
+    # each thread drives its own cat-file worker, so blobs are inflated in parallel while the pipe reads release the GIL
+    shard_size = -(-len(filenames) // n_shards)
+    starts = range(0, len(filenames), shard_size)
+    with ThreadPoolExecutor(max_workers=n_shards) as executor:
+        for files in executor.map(
+            _ingest_blobs,
+            repeat(cm.repo_path),
+            [filenames[start:start + shard_size] for start in starts],
+            [shas[start:start + shard_size] for start in starts],
+            range(len(starts)),
+        ):
+            yield from files
+
+def ingest_files(cm, filenames):
+    return dict(iter_files(cm, filenames))
+
+# source side of each file header. Only "---" lines right after a "diff --git" line and its extended header lines count,
+# so removed lines that happen to read "-- a/..." are never taken for one.
+# The optional tab is what git appends to paths containing spaces and the optional \r covers CRLF patches
+_DIFF_SRC_RE = re.compile(
+    r"^diff --git .*\n"
+    r"(?:(?:old|new|deleted|index|similarity|dissimilarity|rename|copy) .*\n)*"
+    r"--- a/(.+?)\t?\r?\n\+\+\+ ",
+    re.MULTILINE,
+)
+
+class ContentStore(Mapping):
+    """Lazy {filename: content} mapping over a bare clone, contents are only read while iterating items() or values()"""
+
+    def __init__(self, repo_path, base_commit, tree, fetched=False):
+        self.repo_path = repo_path
+        self.base_commit = base_commit
+        self.tree = tree
+        # set once every blob is known to be in the clone, so reads skip probing for missing ones
+        self.fetched = fetched
+
+    def __len__(self):
+        return len(self.tree)
+
+    def __iter__(self):
+        return iter(self.tree)
+
+    def __contains__(self, filename):
+        return filename in self.tree
+
+    def __getitem__(self, filename):
+        return dict(iter_files(self, [filename], fetch=not self.fetched))[filename]
+
+    def keys(self):
+        return self.tree.keys()
+
+    def items(self):
+        return iter_files(self, self.tree, fetch=not self.fetched)
+
+    def values(self):
+        return (content for _, content in self.items())
+
+def get_oracle_filenames(instance, strict=False):
+    """
+    Returns the filenames that are changed in the patch, files added by the patch have no source and are skipped.
+    The headers are matched as plain strings, strict=True runs the full unidiff parser instead for debugging
+    """
+    if strict:
+        return {
+            patch_file.source_file.split("a/", 1)[-1]
+            for patch_file in unidiff.PatchSet(instance["patch"])
+            if patch_file.source_file != "/dev/null"
+        }
+    return set(_DIFF_SRC_RE.findall(instance["patch"]))
+
+
+# get all file contents from the repo
+_TEST_SPLIT_RE = re.compile(r"[ _/.]")
+_TEST_WORDS = frozenset(("test", "tests", "testing"))
+
+def is_test(name):
+    name = name.lower()
+    # every test word contains "test", so most paths are rejected before splitting
+    return "test" in name and not _TEST_WORDS.isdisjoint(_TEST_SPLIT_RE.split(name))
+
+def detect_encoding(rawdata, sniff_size=ENCODING_SNIFF_SIZE):
+    """
+    Detect the encoding of non UTF-8 file contents from their first sniff_size bytes, None sniffs all of them
+    """
+    rawdata = rawdata[:sniff_size]
+    if charset_normalizer is not None:
+        match = charset_normalizer.from_bytes(rawdata).best()
+        return None if match is None else match.encoding
+    detector = chardet.UniversalDetector()
+    for start in range(0, len(rawdata), 4096):
+        detector.feed(rawdata[start:start + 4096])
+        if detector.done:
+            break
+    return detector.close()["encoding"]
+
+def decode_contents(rawdata):
+    """
+    Decode file contents, returning None for binary data
+    """
+    try:
+        return rawdata.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        pass
+    # the head alone can be misleading, so fall back to sniffing the whole file before calling it binary
+    for sniff_size in (ENCODING_SNIFF_SIZE, None):
+        encoding = detect_encoding(rawdata, sniff_size)
+        if encoding is not None:
             try:
-                with open(filename, encoding=encoding) as file:
-                    content = file.read()
+                return rawdata.decode(encoding)
             except (UnicodeDecodeError, LookupError):
-                content = "[BINARY DATA FILE]"
-        files_content[relative_path] = content
-    return files_content
-
-def get_file_contents(input_instances, verbose: bool = False, tmp_dir: str = "/scratch"):
-    orig_dir = os.getcwd()
-    with TemporaryDirectory(dir=tmp_dir if os.path.exists(tmp_dir) else "/tmp") as root_dir:
-        for instance_id, instance in tqdm(
+                pass
+        if len(rawdata) <= ENCODING_SNIFF_SIZE:
+            break
+    return None
+
+def ingest_directory_contents(cm, include_tests=False):
+    """
+    Returns a lazy store over every python file in the tree, with the blobs already downloaded
+    """
+    store = ContentStore(cm.repo_path, cm.base_commit, {
+        filename: sha for filename, sha in cm.tree.items()
+        if filename.endswith(".py") and (include_tests or not is_test(filename))
+    })
+    fetch_missing_blobs(cm.repo_path, cm.base_commit, list(store.tree.values()))
+    store.fetched = True
+    return store
+
+def get_num_procs():
+    return max(int(os.environ.get("SWEBENCH_N_PROCS", os.cpu_count() - 1)), 1)
+
+def _process_instance(task):
+    instance_id, instance, content_cache, verbose = task
+    key = (instance["repo"], instance["base_commit"])
+    digest = hashlib.sha256(f"{instance['repo']}@{instance['base_commit']}".encode()).hexdigest()
+    try:
+        cached = _REPO_COMMIT_CACHE.get(key)
+        if cached is None:
+            cached = content_cache.get(digest)
+            # a stored listing is only usable while its clone still has the commit. The clone may have been
+            # replaced since it was stored, so its blobs are checked for again rather than trusting fetched
+            if cached is not None and "tree" in cached and has_commit(cached["files"].repo_path, instance["base_commit"]):
+                store = cached["files"]
+                fetch_missing_blobs(store.repo_path, store.base_commit, list(store.tree.values()))
+                store.fetched = True
+            else:
+                cached = None
+        if cached is None:
+            with AutoContextManager(instance, verbose=verbose) as cm:
+                cached = {
+                    "readmes": ingest_files(cm, cm.get_readme_files()),
+                    "files": ingest_directory_contents(cm),
+                    "tree": cm.tree,
+                }
+            content_cache.set(digest, cached)
+        _REPO_COMMIT_CACHE.clear()
+        _REPO_COMMIT_CACHE[key] = cached
+        oracle_filenames = get_oracle_filenames(instance)
+        instance["readmes"] = cached["readmes"]
+        instance["file_contents"] = cached["files"]
+        # oracle files are looked up in the whole tree, the corpus only holds non-test python files
+        instance["oracle_file_contents"] = ContentStore(
+            cached["files"].repo_path,
+            cached["files"].base_commit,
+            {filename: cached["tree"][filename] for filename in oracle_filenames if filename in cached["tree"]},
+        )
+        missing = oracle_filenames - cached["files"].keys()
+        if missing:
+            print(f"Instance {instance_id}: oracle files not in the corpus: {sorted(missing)}")
+    except Exception as e:
+        print(f"Failed on instance {instance_id}", e)
+        traceback.print_exc()
+    return instance_id, instance
+
+def iter_file_contents(input_instances, verbose: bool = False, tmp_dir: str = "/scratch", n_procs: int = None):
+    """
+    Yields (instance_id, instance) pairs in completion order, with the file contents filled in
+    """
+    content_cache = diskcache.Cache(
+        os.path.join(tmp_dir if os.path.exists(tmp_dir) else "/tmp", "repo_contents")
+    )
+    tasks = [
+        (instance_id, instance, content_cache, verbose)
+        for instance_id, instance in sorted(
             input_instances.items(),
-            total=len(input_instances),
+            key=lambda item: (item[1]["repo"], item[1]["base_commit"]),
+        )
+    ]
+    n_procs = get_num_procs() if n_procs is None else max(n_procs, 1)
+    with content_cache, multiprocessing.Pool(processes=min(n_procs, max(len(tasks), 1))) as pool:
+        yield from tqdm(
+            pool.imap_unordered(_process_instance, tasks, chunksize=2),
+            total=len(tasks),
             desc="Getting file contents",
-        ):
-            try:
-                with AutoContextManager(instance, root_dir, verbose=verbose) as cm:
-                    readmes = cm.get_readme_files()
-                    instance["readmes"] = ingest_files(readmes)
-                    instance["oracle_file_contents"] = ingest_files(get_oracle_filenames(instance))
-                    instance["file_contents"] = ingest_directory_contents(cm.repo_path)
-                    assert all([
-                        okey in instance["file_contents"] 
-                        for okey in instance["oracle_file_contents"].keys()
-                    ])
-            except Exception as e:
-                print(f"Failed on instance {instance_id}", e)
-                traceback.print_exc()
-            finally:
-                # if AutoContextManager fails to exit properly future exits will return the wrong directory
-                os.chdir(orig_dir)
-    os.chdir(orig_dir)
-
-def file(dataset, name):
-    for item in dataset:
+        )
+
+def get_file_contents(input_instances, verbose: bool = False, tmp_dir: str = "/scratch", n_procs: int = None):
+    for instance_id, instance in iter_file_contents(input_instances, verbose=verbose, tmp_dir=tmp_dir, n_procs=n_procs):
+        input_instances[instance_id] = instance
+
+def build_file_level(dataset, name):
+    item_dict = {item["instance_id"]: item for item in dataset}
+    for instance_id, instance in iter_file_contents(item_dict, tmp_dir=args.tmp_dir, n_procs=args.n_procs):
+        if "file_contents" not in instance:
+            continue
         queries = [{
-            "_id": item["instance_id"],
-            "text": item["problem_statement"], 
+            "_id": instance_id,
+            "text": instance["problem_statement"], 
             "metadata": {}
         }]
-        item_dict = {item["instance_id"]: item}
-        get_file_contents(item_dict, tmp_dir=args.tmp_dir)
-        docs = []
-        for instance_id, instance in item_dict.items():
-            print(f"Instance #{instance_id}: {len(instance['oracle_file_contents'])} oracle / {len(instance['file_contents'])} files")
-            for filename, content in instance["file_contents"].items():
-                docs.append({
-                    "_id": f"{instance_id}_{filename}",
-                    "title": filename,
-                    "text": content,
-                    "metadata": {},
-                })
+        print(f"Instance #{instance_id}: {len(instance['oracle_file_contents'])} oracle / {len(instance['file_contents'])} files")
+        # streamed from the clone into corpus.jsonl instead of being held in memory
+        docs = (
+            {
+                "_id": f"{instance_id}_{filename}",
+                "title": filename,
+                "text": content,
+                "metadata": {},
+            }
+            for filename, content in instance["file_contents"].items()
+        )
 
         qrels = []
-        for instance_id, instance in item_dict.items():
-            for filename, content in instance["oracle_file_contents"].items():
-                qrels.append({
-                    "query-id": instance_id,
-                    "corpus-id": f"{instance_id}_{filename}",
-                    "score": 1
-                }) 
+        for filename in instance["oracle_file_contents"]:
+            qrels.append({
+                "query-id": instance_id,
+                "corpus-id": f"{instance_id}_{filename}",
+                "score": 1
+            }) 
 
         path = os.path.join(args.dataset_dir, f"{name}_{instance_id}")
-        os.makedirs(path, exist_ok=True)
-        os.makedirs(os.path.join(path, "qrels"), exist_ok=True)
-        
-        save_file_jsonl(queries, os.path.join(path, "queries.jsonl"))
-        save_file_jsonl(docs, os.path.join(path, "corpus.jsonl"))
-        qrels_path = os.path.join(path, "qrels", "test.tsv")
-        save_tsv_dict(qrels, qrels_path, ["query-id", "corpus-id", "score"])
+        # the corpus is read from the clone while it is written, so build the directory aside and only move it in once complete
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+        try:
+            os.makedirs(os.path.join(tmp_path, "qrels"))
+            save_file_jsonl(queries, os.path.join(tmp_path, "queries.jsonl"))
+            save_file_jsonl(docs, os.path.join(tmp_path, "corpus.jsonl"))
+            qrels_path = os.path.join(tmp_path, "qrels", "test.tsv")
+            save_tsv_dict(qrels, qrels_path, ["query-id", "corpus-id", "score"])
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Failed on instance {instance_id}", e)
+            traceback.print_exc()
+            shutil.rmtree(tmp_path, ignore_errors=True)
 
-def function(dataset, name):
-    #TODO: validate this extensively on each instance
-    for i, item in tqdm(enumerate(dataset), total = len(dataset), colour= 'blue'):
-        if os.path.exists(f"datasets/{name}_{item['instance_id']}"):
-            continue
-        
-        queries = [{
-            "_id": item["instance_id"],
-            "text": item["problem_statement"], 
-            "metadata": {}
-        }]
-        
+def get_scratch_root(tmp_dir, ramdisk_root="/dev/shm", n_clones=1, clone_size=1024**3):
+    """
+    Returns where throwaway clones should go, the RAM disk when it has room for n_clones of clone_size bytes at once,
+    tmp_dir otherwise
+    """
+    if ramdisk_root and os.path.isdir(ramdisk_root) and shutil.disk_usage(ramdisk_root).free > n_clones * clone_size:
+        return ramdisk_root
+    os.makedirs(tmp_dir, exist_ok=True)
+    return tmp_dir
+
+def get_project_structure_from_cache(item, playground):
+    """
+    Parses the tree of base_commit, unpacked from the cached bare clone instead of cloning the repo for every commit
+    """
+    with AutoContextManager(item) as cm:
+        fetch_missing_blobs(cm.repo_path, cm.base_commit, list(cm.tree.values()))
+        repo_playground = os.path.join(playground, str(uuid.uuid4()))
+        repo_dir = os.path.join(repo_playground, repo_to_top_folder[item["repo"]])
+        os.makedirs(repo_dir)
+        # a private index keeps workers that unpack the same clone at once from sharing one
+        env = {**os.environ, "GIT_INDEX_FILE": os.path.join(repo_playground, "index")}
         try:
-            structure = get_project_structure_from_scratch(item['repo'], item['base_commit'], 
-                                                        item['instance_id'], 'playground')
-            data = find_py_or_non_dict_with_path(structure['structure'], cond = item["instance_id"].startswith('pytest-dev__'))
-            patch_info = parse_patch_full(item['patch'], structure)
-        except:
-            import pdb;pdb.set_trace()
-        changed_funcs = set()
-        for fle, hunks in patch_info.items():
-            for hunk in hunks:
-                if hunk['function_changed'] and hunk['newly_added'] is False:
-                    if hunk['class_changed']:
-                        changed_funcs.add(f'{fle}/{hunk["class_changed"]}/{hunk["function_changed"]}')
-                    else:
-                        changed_funcs.add(f'{fle}/{hunk["function_changed"]}')
-        
-        if not changed_funcs:
-            #import pdb;pdb.set_trace()
-            continue
-        
-        docs = []
-        for func, content in data.items():
-            docs.append({
-                    "_id": func,
-                    "title": '',
-                    "text": content,
-                    "metadata": {},
-                })
-        qrels = []
-        for func in changed_funcs:
-            try:
-                assert func in data
-            except:
-                import pdb;pdb.set_trace()
-            qrels.append({
-                    "query-id": item["instance_id"],
-                    "corpus-id": func,
-                    "score": 1
-                })
-        
-        path = os.path.join(args.dataset_dir, f"{name}_{item['instance_id']}")
-        os.makedirs(path, exist_ok=True)
-        os.makedirs(os.path.join(path, "qrels"), exist_ok=True)
-        
-        save_file_jsonl(queries, os.path.join(path, "queries.jsonl"))
-        save_file_jsonl(docs, os.path.join(path, "corpus.jsonl"))
-        qrels_path = os.path.join(path, "qrels", "test.tsv")
-        save_tsv_dict(qrels, qrels_path, ["query-id", "corpus-id", "score"])
+            for command in (["read-tree", cm.base_commit], ["checkout-index", "--all", "--force"]):
+                subprocess.run(
+                    ["git", "--git-dir", cm.repo_path, "--work-tree", repo_dir, *command],
+                    check=True,
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                )
+            structure = create_structure(repo_dir)
+        finally:
+            shutil.rmtree(repo_playground, ignore_errors=True)
+    return {
+        "repo": item["repo"],
+        "base_commit": item["base_commit"],
+        "structure": structure,
+        "instance_id": item["instance_id"],
+    }
+
+def get_project_structure(item, playground, structure_cache):
+    """
+    Returns the parsed structure of the repo at base_commit, computed once per (repo, base_commit)
+    """
+    key = f"{item['repo']}@{item['base_commit']}"
+    # workers racing on the same commit wait for the first one instead of cloning and parsing it again
+    with diskcache.Lock(structure_cache, f"lock:{key}", expire=3600):
+        structure = structure_cache.get(key)
+        if structure is None:
+            # the commit itself is unpacked, a failure raises instead of leaving another tree to be cached
+            structure = get_project_structure_from_cache(item, playground)
+            structure_cache.set(key, structure, expire=None)
+    return {**structure, "instance_id": item["instance_id"]}
+
+def _process_function_instance(item, name, playground, dataset_dir, structure_cache):
+    #TODO: validate this extensively on each instance
+    queries = [{
+        "_id": item["instance_id"],
+        "text": item["problem_statement"], 
+        "metadata": {}
+    }]
+    
+    try:
+        structure = get_project_structure(item, playground, structure_cache)
+        data = find_py_or_non_dict_with_path(structure['structure'], cond = item["instance_id"].startswith('pytest-dev__'))
+        patch_info = parse_patch_full(item['patch'], structure)
+    except Exception as e:
+        print(f"Failed on instance {item['instance_id']}", e)
+        traceback.print_exc()
+        return
+    changed_funcs = set()
+    for fle, hunks in patch_info.items():
+        for hunk in hunks:
+            if hunk['function_changed'] and hunk['newly_added'] is False:
+                if hunk['class_changed']:
+                    changed_funcs.add(f'{fle}/{hunk["class_changed"]}/{hunk["function_changed"]}')
+                else:
+                    changed_funcs.add(f'{fle}/{hunk["function_changed"]}')
+    
+    if not changed_funcs:
+        return
+    
+    docs = []
+    for func, content in data.items():
+        docs.append({
+                "_id": func,
+                "title": '',
+                "text": content,
+                "metadata": {},
+            })
+    qrels = []
+    for func in changed_funcs:
+        if func not in data:
+            print(f"Skipping instance {item['instance_id']}: changed function {func} not found in corpus")
+            return
+        qrels.append({
+                "query-id": item["instance_id"],
+                "corpus-id": func,
+                "score": 1
+            })
+    
+    path = os.path.join(dataset_dir, f"{name}_{item['instance_id']}")
+    os.makedirs(path, exist_ok=True)
+    os.makedirs(os.path.join(path, "qrels"), exist_ok=True)
+    
+    save_file_jsonl(queries, os.path.join(path, "queries.jsonl"))
+    save_file_jsonl(docs, os.path.join(path, "corpus.jsonl"))
+    qrels_path = os.path.join(path, "qrels", "test.tsv")
+    save_tsv_dict(qrels, qrels_path, ["query-id", "corpus-id", "score"])
+
+def function(dataset, name):
+    todo = sorted(
+        (item for item in dataset if not os.path.exists(os.path.join(args.dataset_dir, f"{name}_{item['instance_id']}"))),
+        key=lambda item: (item["repo"], item["base_commit"]),
+    )
+    if not todo:
+        return
+    # sorted by repo, so each worker gets contiguous runs of instances from the same repo
+    chunksize = max(len(todo) // (args.n_procs * 4), 1)
+    # every commit is unpacked into a working tree only to parse it and delete it, so keep it off the disk when possible.
+    # Every worker holds its own tree in the playground at the same time
+    scratch_root = get_scratch_root(
+        args.tmp_dir,
+        ramdisk_root=args.ramdisk_root,
+        n_clones=args.n_procs,
+        clone_size=int(args.clone_size_gb * 1024**3),
+    )
+    structure_cache = diskcache.Cache(os.path.join(args.cache_dir, "structure"))
+    with structure_cache, TemporaryDirectory(dir=scratch_root) as playground, ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+        process = partial(
+            _process_function_instance,
+            name=name,
+            playground=playground,
+            dataset_dir=args.dataset_dir,
+            structure_cache=structure_cache,
+        )
+        for _ in tqdm(executor.map(process, todo, chunksize=chunksize), total=len(todo), colour='blue'):
+            pass
+
+def remove_cached_datasets(dataset_dir, prefixes):
+    """
+    Moves the matching dataset directories aside first, so they disappear from dataset_dir at once, then deletes them in parallel
+    """
+    dirs_to_remove = []
+    for instance in os.listdir(dataset_dir):
+        if instance.startswith(prefixes):
+            target = os.path.join(dataset_dir, instance)
+            deleting = f"{target}.deleting-{uuid.uuid4().hex}"
+            os.rename(target, deleting)
+            dirs_to_remove.append(deleting)
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(shutil.rmtree, dirs_to_remove))
+
+_LEVELS = {"file": build_file_level, "function": function}
 
 def main():
     dataset = datasets.load_dataset(args.dataset_name, cache_dir=args.cache_dir)[args.split]
@@ -288,8 +699,8 @@ def main():
         name += f"-{args.level}"
     
     if not args.reuse_cached:
-        [shutil.rmtree(f'{args.dataset_dir}/{instance}') for instance in os.listdir(f'{args.dataset_dir}') if instance.startswith(f'{name}_') or instance.startswith(f'csn_{args.level}_')]
-    eval(args.level)(dataset, name)
+        remove_cached_datasets(args.dataset_dir, (f'{name}_', f'csn_{args.level}_'))
+    _LEVELS[args.level](dataset, name)
     
     
 
@@ -298,12 +709,20 @@ if __name__ == "__main__":
     parser.add_argument("--dataset_name", type=str, default="princeton-nlp/SWE-bench_Lite",
                         choices=["princeton-nlp/SWE-bench", "princeton-nlp/SWE-bench_Lite", "princeton-nlp/SWE-bench_Verified"])
     parser.add_argument("--split", type=str, default="test")
-    parser.add_argument("--level", type=str, default="function")
+    parser.add_argument("--level", type=str, default="function", choices=list(_LEVELS))
     parser.add_argument("--cache_dir", type=str, default="cache/")
     parser.add_argument("--tmp_dir", type=str, default="tmp/")
+    parser.add_argument("--ramdisk_root", type=str, default="/dev/shm",
+                        help="RAM disk preferred for throwaway clones when it has enough free space")
+    parser.add_argument("--clone_size_gb", type=float, default=1.0,
+                        help="RAM disk space to reserve per worker's clone, --tmp_dir is used when it does not fit")
     parser.add_argument("--dataset_dir", type=str, default="datasets")
     parser.add_argument("--num_examples", type=int, default=None)
+    parser.add_argument("--n_procs", type=int, default=get_num_procs(),
+                        help="worker processes, defaults to $SWEBENCH_N_PROCS or one less than the cpu count")
     parser.add_argument("--reuse_cached", type=bool, default=True)
     args = parser.parse_args()
+    # clamped like get_num_procs, there is always at least one worker
+    args.n_procs = max(args.n_procs, 1)
 
     main()
@@ -1,5 +1,6 @@
 import jsonlines
 import csv
+import orjson
 import os
 from tqdm import tqdm 
 import json 
@@ -9,17 +10,19 @@ def load_jsonlines(file):
     return lst
 
 def save_file_jsonl(data, fp):
-    with jsonlines.open(fp, mode='w') as writer:
-        writer.write_all(data)
+    # corpus entries hold whole source files, orjson encodes them straight to utf-8 bytes
+    with open(fp, 'wb', buffering=1 << 20) as writer:
+        for d in data:
+            writer.write(orjson.dumps(d) + b"\n")
 
 def save_tsv_dict(data, fp, fields):
     # build dir
     dir_path = os.path.dirname(fp)
     os.makedirs(dir_path, exist_ok=True)
     
-    # writing to csv file
-    with open(fp, 'w') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fields, delimiter='\t',)
+    # writing to tsv file
+    with open(fp, 'w', newline='') as tsvfile:
+        writer = csv.DictWriter(tsvfile, fieldnames=fields, delimiter='\t', lineterminator='\n')
         writer.writeheader()
         writer.writerows(data)
 
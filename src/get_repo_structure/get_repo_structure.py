@@ -175,7 +175,9 @@ def create_structure(directory_path):
     """
     structure = {}
 
-    for root, _, files in os.walk(directory_path):
+    for root, dirs, files in os.walk(directory_path):
+        # prune in place so the walk never descends into git's object store
+        dirs[:] = [d for d in dirs if d != ".git"]
         repo_name = os.path.basename(directory_path)
         relative_root = os.path.relpath(root, directory_path)
         if relative_root == ".":